@@ -13,6 +13,7 @@ from typing import Dict, List, Optional, Tuple
 import jsonschema
 import numpy as np
 from PIL import Image, ImageFilter
+from scipy import ndimage
 import torch
 import torchvision.transforms as transforms
 import wandb
@@ -99,6 +100,27 @@ def add_subvolume_arguments(parser):
     )
 
 
+def overlapping_slices(
+    left: int, top: int, shape: Tuple[int, int], image_shape: Tuple[int, ...]
+) -> Tuple[Tuple[slice, slice], Tuple[slice, slice]]:
+    """Return the slices that overlap a window with an image, in both image and window space.
+
+    The window has (height, width) shape and its top left corner at (left, top) in the image,
+    possibly hanging off the edges. Indexing the image with the first pair of slices and the
+    window with the second gives the same (possibly empty) region, so copying between them
+    replaces a per-pixel bounds check.
+
+    """
+    image_idx, window_idx = [], []
+    for start, length, limit in zip((top, left), shape, image_shape):
+        lo, hi = max(start, 0), min(start + length, limit)
+        if hi <= lo:  # No overlap on this axis
+            lo = hi = start = 0
+        image_idx.append(slice(lo, hi))
+        window_idx.append(slice(lo - start, hi - start))
+    return tuple(image_idx), tuple(window_idx)
+
+
 # Tuple (not dataclass) I believe because needs to be passed through PyTorch and needs to be basic structure
 FeatureMetadata = namedtuple(
     "FeatureMetadata",
@@ -146,7 +168,9 @@ class DataSource(ABC):
         raise NotImplementedError
 
     @staticmethod
-    def from_path(path: str, lazy_load: bool = False) -> DataSource:
+    def from_path(
+        path: str, lazy_load: bool = False, volume_cache_dir: Optional[str] = None
+    ) -> DataSource:
         """Check first whether this is a region or volume data source, then instantiate accordingly.
 
         Also checks to make sure the old region set file format was not provided. If it was,
@@ -163,9 +187,11 @@ class DataSource(ABC):
                 f"\tpython inkid/scripts/update_data_file.py {path}"
             )
         if source_json.get("type") == "region":
-            return RegionSource(path, lazy_load=lazy_load)
+            return RegionSource(
+                path, lazy_load=lazy_load, volume_cache_dir=volume_cache_dir
+            )
         elif source_json.get("type") == "volume":
-            return VolumeSource(path)
+            return VolumeSource(path, volume_cache_dir=volume_cache_dir)
         else:
             raise ValueError(
                 f'Source file {path} does not specify valid "type" of "region" or "volume"'
@@ -179,7 +205,12 @@ class RegionSource(DataSource):
 
     """
 
-    def __init__(self, path: str, lazy_load: bool = False) -> None:
+    def __init__(
+        self,
+        path: str,
+        lazy_load: bool = False,
+        volume_cache_dir: Optional[str] = None,
+    ) -> None:
         super().__init__(path)
 
         # Initialize region's PPM, volume, etc
@@ -192,7 +223,7 @@ class RegionSource(DataSource):
             self.volume = None
         else:
             self.volume: inkid.data.Volume = inkid.data.Volume.from_path(
-                self.source_json["volume"]
+                self.source_json["volume"], cache_dir=volume_cache_dir
             )
 
         # Mask and label images
@@ -319,41 +350,46 @@ class RegionSource(DataSource):
             ambiguous_labels_mask = Image.fromarray(self._ink_label)
             # 3x3 Laplacian kernel for edge detection
             ambiguous_labels_mask = ambiguous_labels_mask.filter(ImageFilter.FIND_EDGES)
-            # Max filter for dilation
+            # Max filter for dilation. The separable ndimage filter costs the same per pixel
+            # regardless of radius, unlike PIL's rank filter which scans the whole window
             dilation_kernel_width = int(
                 2 * self.sampler.ambiguous_ink_labels_filter_radius + 1
             )
-            ambiguous_labels_mask = ambiguous_labels_mask.filter(
-                ImageFilter.MaxFilter(dilation_kernel_width)
+            self.sampler.ambiguous_labels_mask = ndimage.maximum_filter(
+                np.array(ambiguous_labels_mask),
+                size=dilation_kernel_width,
+                mode="nearest",
             )
-            self.sampler.ambiguous_labels_mask = np.array(ambiguous_labels_mask)
+        # Apply the point filters to the whole sampling grid at once rather than point by point
+        x0, y0, x1, y1 = self.bounding_box
+        ys = np.arange(y0, min(y1, self._mask.shape[0]), self.sampler.grid_spacing)
+        xs = np.arange(x0, min(x1, self._mask.shape[1]), self.sampler.grid_spacing)
+        grid = np.ix_(ys, xs)
+        keep = self._surface_mask()[grid]
+        if self.sampler.specify_inkness is not None:
+            ink = self._ink_label[grid] != 0
+            keep &= ink if self.sampler.specify_inkness else ~ink
+        # Filter out points with ambiguous ink labels
+        if self.sampler.ambiguous_labels_mask is not None:
+            keep &= self.sampler.ambiguous_labels_mask[grid] == 0
+        # np.nonzero() walks the grid in row-major order, the same order as iterating over y and then x
+        keep_ys, keep_xs = np.nonzero(keep)
+        points = list(zip(xs[keep_xs].tolist(), ys[keep_ys].tolist()))
         positive_points = list()
         negative_points = list()
         unlabeled_points = list()
-        x0, y0, x1, y1 = self.bounding_box
-        for y in range(y0, y1, self.sampler.grid_spacing):
-            for x in range(x0, x1, self.sampler.grid_spacing):
-                if not self.is_on_surface(x, y):
-                    continue
-                if self.sampler.specify_inkness is not None:
-                    if self.sampler.specify_inkness and not self.is_ink(x, y):
-                        continue
-                    elif not self.sampler.specify_inkness and self.is_ink(x, y):
-                        continue
-                # Filter out points with ambiguous ink labels
-                if self.sampler.ambiguous_labels_mask is not None:
-                    if self.sampler.ambiguous_labels_mask[y, x] != 0:
-                        continue
-                if (
-                    self.sampler.oversampling_ink_ratio is not None
-                    or self.sampler.undersampling_ink_ratio is not None
-                ):
-                    if self.is_ink(x, y):
-                        positive_points.append((x, y))
-                    else:
-                        negative_points.append((x, y))
+        if (
+            self.sampler.oversampling_ink_ratio is not None
+            or self.sampler.undersampling_ink_ratio is not None
+        ):
+            ink = self._ink_label[grid][keep_ys, keep_xs] != 0
+            for point, point_is_ink in zip(points, ink):
+                if point_is_ink:
+                    positive_points.append(point)
                 else:
-                    unlabeled_points.append((x, y))
+                    negative_points.append(point)
+        else:
+            unlabeled_points = points
 
         """
         For the given ink ratio,
@@ -423,6 +459,28 @@ class RegionSource(DataSource):
         square = self._mask[y - r : y + r + 1, x - r : x + r + 1]
         return np.size(square) > 0 and np.min(square) != 0
 
+    def _surface_mask(self, r: int = 1) -> np.ndarray:
+        """Return a boolean image of is_on_surface() evaluated at every point of the mask.
+
+        Erodes the mask with the same square used by is_on_surface(). Out of bounds pixels
+        are ignored, as the slice there is truncated at the far edges, but points within r of
+        the near edges are never on the surface since their slice starts at a negative index.
+
+        """
+        assert self._mask is not None
+        surface = self._mask != 0
+        # Multichannel masks count as on the surface where all channels are
+        if surface.ndim == 3:
+            surface = np.all(surface, axis=2)
+        on_surface = ndimage.binary_erosion(
+            surface,
+            structure=np.ones((2 * r + 1, 2 * r + 1), dtype=bool),
+            border_value=1,
+        )
+        on_surface[:r, :] = False
+        on_surface[:, :r] = False
+        return on_surface
+
     def get_default_bounds(self) -> Tuple[int, int, int, int]:
         """Return the full bounds of the PPM in (x0, y0, x1, y1) format."""
         return 0, 0, self._ppm.width, self._ppm.height
@@ -435,20 +493,11 @@ class RegionSource(DataSource):
         y_d, x_d = (
             np.array(shape) // 2
         )  # Calculate distance from center to edges of square we are sampling
-        # Iterate over label indices
-        for idx, _ in np.ndenumerate(label):
-            y_idx, x_idx = idx
-            y_s = (
-                y - y_d + y_idx
-            )  # Sample point is center minus distance (half edge length) plus label index
-            x_s = x - x_d + x_idx
-            # Bounds check to make sure inside PPM
-            if (
-                0 <= y_s < self._ink_label.shape[0]
-                and 0 <= x_s < self._ink_label.shape[1]
-            ):
-                if self._ink_label[y_s, x_s] != 0:
-                    label[y_idx, x_idx] = 1.0  # Mark this "ink"
+        # Copy the part of the square that is inside the PPM, leaving the rest "no ink"
+        image_idx, label_idx = overlapping_slices(
+            x - x_d, y - y_d, shape, self._ink_label.shape
+        )
+        label[label_idx] = self._ink_label[image_idx] != 0
         return torch.Tensor(label).long()
 
     def point_to_rgb_values_label(self, point, shape):
@@ -458,19 +507,13 @@ class RegionSource(DataSource):
         y_d, x_d = (
             np.array(shape) // 2
         )  # Calculate distance from center to edges of square we are sampling
-        # Iterate over label indices
-        for idx, _ in np.ndenumerate(label):
-            _, y_idx, x_idx = idx
-            y_s = (
-                y - y_d + y_idx
-            )  # Sample point is center minus distance (half edge length) plus label index
-            x_s = x - x_d + x_idx
-            # Bounds check to make sure inside PPM
-            if (
-                0 <= y_s < self._rgb_label.shape[0]
-                and 0 <= x_s < self._rgb_label.shape[1]
-            ):
-                label[:, y_idx, x_idx] = self._rgb_label[y_s, x_s]
+        # Copy the part of the square that is inside the PPM, moving channels first
+        image_idx, label_idx = overlapping_slices(
+            x - x_d, y - y_d, shape, self._rgb_label.shape
+        )
+        label[(slice(None),) + label_idx] = np.moveaxis(
+            self._rgb_label[image_idx], -1, 0
+        )
         return label
 
     def point_to_volcart_texture_label(self, point, shape):
@@ -480,19 +523,11 @@ class RegionSource(DataSource):
         y_d, x_d = (
             np.array(shape) // 2
         )  # Calculate distance from center to edges of square we are sampling
-        # Iterate over label indices
-        for idx, _ in np.ndenumerate(label):
-            _, y_idx, x_idx = idx
-            y_s = (
-                y - y_d + y_idx
-            )  # Sample point is center minus distance (half edge length) plus label index
-            x_s = x - x_d + x_idx
-            # Bounds check to make sure inside PPM
-            if (
-                0 <= y_s < self._volcart_texture_label.shape[0]
-                and 0 <= x_s < self._volcart_texture_label.shape[1]
-            ):
-                label[0, y_idx, x_idx] = self._volcart_texture_label[y_s, x_s]
+        # Copy the part of the square that is inside the PPM
+        image_idx, label_idx = overlapping_slices(
+            x - x_d, y - y_d, shape, self._volcart_texture_label.shape
+        )
+        label[0][label_idx] = self._volcart_texture_label[image_idx]
         return label
 
     def store_prediction(self, x, y, prediction, label_type):
@@ -512,38 +547,39 @@ class RegionSource(DataSource):
             )
         # Calculate distance from center to edges of square we are writing
         y_d, x_d = np.array(prediction.shape)[1:] // 2
-        # Iterate over label indices
-        for idx in np.ndindex(prediction.shape[1:]):
-            y_idx, x_idx = idx
-            value = prediction[:, y_idx, x_idx]
-            # Sample point in PPM space is center minus distance (half edge length) plus label index
-            y_s = y - y_d + y_idx
-            x_s = x - x_d + x_idx
-            # Bounds check to make sure inside PPM
-            if 0 <= x_s < self._ppm.width and 0 <= y_s < self._ppm.height:
-                if label_type == "ink_classes":
-                    # Convert ink class probability to image intensity
-                    v = value[1] * np.iinfo(np.uint16).max
-                    self._ink_classes_prediction_image[y_s, x_s] = v
-                    self._ink_classes_prediction_image_written_to = True
-                elif label_type == "rgb_values":
-                    # Rescale from [0, 1] to [0, 255]
-                    v = value * np.iinfo(np.uint8).max
-                    # Restrict value to uint8 range
-                    v = np.clip(v, 0, np.iinfo(np.uint8).max)
-                    self._rgb_values_prediction_image[y_s, x_s] = v
-                    self._rgb_values_prediction_image_written_to = True
-                elif label_type == "volcart_texture":
-                    # Rescale from [0, 1]
-                    v = value[0] * np.iinfo(np.uint16).max
-                    # Restrict value to uint16 range
-                    v = np.clip(v, 0, np.iinfo(np.uint16).max)
-                    self._volcart_texture_prediction_image[y_s, x_s] = v
-                    self._volcart_texture_prediction_image_written_to = True
-                else:
-                    raise ValueError(
-                        f"Unknown label_type: {label_type} used for prediction"
-                    )
+        # Sample point in PPM space is center minus distance (half edge length) plus label index.
+        # Write only the part of the square that lies inside the PPM
+        image_idx, prediction_idx = overlapping_slices(
+            x - x_d,
+            y - y_d,
+            prediction.shape[1:],
+            (self._ppm.height, self._ppm.width),
+        )
+        # Nothing to write (or mark as written) if the square misses the PPM entirely
+        if any(axis.stop <= axis.start for axis in image_idx):
+            return
+        if label_type == "ink_classes":
+            # Convert ink class probability to image intensity
+            v = prediction[1][prediction_idx] * np.iinfo(np.uint16).max
+            self._ink_classes_prediction_image[image_idx] = v
+            self._ink_classes_prediction_image_written_to = True
+        elif label_type == "rgb_values":
+            # Rescale from [0, 1] to [0, 255], channels last as in the image
+            v = np.moveaxis(prediction[(slice(None),) + prediction_idx], 0, -1)
+            v = v * np.iinfo(np.uint8).max
+            # Restrict value to uint8 range
+            v = np.clip(v, 0, np.iinfo(np.uint8).max)
+            self._rgb_values_prediction_image[image_idx] = v
+            self._rgb_values_prediction_image_written_to = True
+        elif label_type == "volcart_texture":
+            # Rescale from [0, 1]
+            v = prediction[0][prediction_idx] * np.iinfo(np.uint16).max
+            # Restrict value to uint16 range
+            v = np.clip(v, 0, np.iinfo(np.uint16).max)
+            self._volcart_texture_prediction_image[image_idx] = v
+            self._volcart_texture_prediction_image_written_to = True
+        else:
+            raise ValueError(f"Unknown label_type: {label_type} used for prediction")
 
     def write_predictions(self, directory, suffix, step=-1):
         """Write the buffered prediction images to disk."""
@@ -612,7 +648,7 @@ class VolumeSource(DataSource):
 
     """
 
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, volume_cache_dir: Optional[str] = None) -> None:
         super().__init__(path)
 
         self.volume_bounding_box = self.source_json.get("volume_bounding_box")
@@ -621,6 +657,7 @@ class VolumeSource(DataSource):
         self.volume: inkid.data.Volume = inkid.data.Volume.from_path(
             self.source_json["volume"],
             bounding_box=self.volume_bounding_box,
+            cache_dir=volume_cache_dir,
         )
 
     def __len__(self):
@@ -716,7 +753,12 @@ class Dataset(torch.utils.data.Dataset):
 
     """
 
-    def __init__(self, source_paths: List[str], lazy_load: bool = False) -> None:
+    def __init__(
+        self,
+        source_paths: List[str],
+        lazy_load: bool = False,
+        volume_cache_dir: Optional[str] = None,
+    ) -> None:
         """Initialize the dataset given .json data source and/or .txt dataset paths.
 
         This recursively expands any provided .txt dataset files until there is just a
@@ -725,12 +767,21 @@ class Dataset(torch.utils.data.Dataset):
 
         Args:
             source_paths: A list of .txt dataset or .json data source file paths.
+            lazy_load: Defer loading region PPMs until they are first accessed, and
+                skip loading region volumes entirely (such regions cannot produce
+                subvolumes). Volume sources are always loaded.
+            volume_cache_dir: Directory for memory-mappable copies of the volumes
+                (see Volume), or None to load volumes into memory on every run.
 
         """
         source_paths = flatten_data_sources_list(source_paths)
         self.sources: List[DataSource] = list()
         for source_path in source_paths:
-            self.sources.append(DataSource.from_path(source_path, lazy_load=lazy_load))
+            self.sources.append(
+                DataSource.from_path(
+                    source_path, lazy_load=lazy_load, volume_cache_dir=volume_cache_dir
+                )
+            )
 
     def __len__(self) -> int:
         return sum([len(source) for source in self.sources])
@@ -2,12 +2,12 @@
 from __future__ import annotations
 
 import logging
+import os
 import re
-import struct
 from typing import Dict, Optional
+from urllib.parse import urlsplit
 
 import numpy as np
-from tqdm import tqdm
 
 import inkid.util
 
@@ -25,6 +25,7 @@ class PPM:
         self.ordered: bool = header["ordered"]
         self.type: str = header["type"]
         self.version: str = header["version"]
+        self._header_length: int = header["header_length"]
 
         self.data: Optional[np.typing.ArrayLike] = None
 
@@ -63,7 +64,7 @@ class PPM:
 
         width, height, dim, ordered, val_type, version = [None] * 6
 
-        data = inkid.util.get_raw_data_from_file_or_url(filename)
+        data = PPM.open_ppm(filename)
         while True:
             line = data.readline().decode("utf-8")
             if comments_re.match(line):
@@ -87,6 +88,8 @@ class PPM:
                 logging.warning(
                     "PPM header contains unknown line: {}".format(line.strip())
                 )
+        header_length = data.tell()
+        data.close()
 
         return {
             "width": width,
@@ -95,8 +98,17 @@ class PPM:
             "ordered": ordered,
             "type": val_type,
             "version": version,
+            "header_length": header_length,
         }
 
+    @staticmethod
+    def open_ppm(path):
+        # Open local files directly so reading the header does not pull the
+        # whole body into memory. URLs have to be fetched in full.
+        if urlsplit(path).scheme == "":
+            return open(path, "rb")
+        return inkid.util.get_raw_data_from_file_or_url(path)
+
     @staticmethod
     def write_ppm_from_data(
         path: str,
@@ -107,21 +119,34 @@ class PPM:
         ordered: bool = True,
         version: str = "1.0",
     ):
-        with open(path, "wb") as f:
-            logging.info("Writing PPM to file {}...".format(path))
-            f.write("width: {}\n".format(width).encode("utf-8"))
-            f.write("height: {}\n".format(height).encode("utf-8"))
-            f.write("dim: {}\n".format(dim).encode("utf-8"))
-            f.write(
-                "ordered: {}\n".format("true" if ordered else "false").encode("utf-8")
-            )
-            f.write("type: double\n".encode("utf-8"))
-            f.write("version: {}\n".format(version).encode("utf-8"))
-            f.write("<>\n".encode("utf-8"))
-            for y in tqdm(range(height)):
-                for x in range(width):
-                    for idx in range(dim):
-                        f.write(struct.pack("d", data[y, x, idx]))
+        data = np.asarray(data)
+        assert data.shape == (height, width, dim)
+
+        # Write next to the target and move it into place, so a PPM can be
+        # written back to the file its data is still mapped from
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "wb") as f:
+                logging.info("Writing PPM to file {}...".format(path))
+                f.write("width: {}\n".format(width).encode("utf-8"))
+                f.write("height: {}\n".format(height).encode("utf-8"))
+                f.write("dim: {}\n".format(dim).encode("utf-8"))
+                f.write(
+                    "ordered: {}\n".format("true" if ordered else "false").encode(
+                        "utf-8"
+                    )
+                )
+                f.write("type: double\n".encode("utf-8"))
+                f.write("version: {}\n".format(version).encode("utf-8"))
+                f.write("<>\n".encode("utf-8"))
+                # The body is row-major doubles in [y, x, idx] order, which is
+                # exactly the memory layout of a C-contiguous float64 array
+                body = np.ascontiguousarray(data, dtype=np.float64)
+                f.write(body.tobytes())
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, path)
 
     def load_ppm_data(self):
         """Read the PPM file data and store it in the PPM object.
@@ -139,22 +164,41 @@ class PPM:
             f"height {self.height}, dim {self.dim}..."
         )
 
-        self.data = np.empty((self.height, self.width, self.dim))
+        shape = (self.height, self.width, self.dim)
+        nbytes = int(np.prod(shape)) * np.dtype(np.float64).itemsize
+
+        if urlsplit(self._path).scheme == "":
+            # Map local files rather than reading them, so the body is paged in
+            # as it is used and shared through the page cache. Copy-on-write
+            # keeps in-place edits such as translate() out of the file.
+            file_size = os.path.getsize(self._path)
+            if file_size - self._header_length < nbytes:
+                raise ValueError(
+                    f"PPM {self._path} data is truncated: expected {nbytes} "
+                    f"bytes but found {file_size - self._header_length}"
+                )
+            self.data = np.memmap(
+                self._path,
+                dtype=np.float64,
+                mode="c",
+                offset=self._header_length,
+                shape=shape,
+            )
+            return
 
-        data = inkid.util.get_raw_data_from_file_or_url(self._path)
-        header_terminator_re = re.compile("^<>$")
-        while True:
-            line = data.readline().decode("utf-8")
-            if header_terminator_re.match(line):
-                break
+        self.data = np.empty(shape)
 
-        for y in tqdm(range(self.height)):
-            for x in range(self.width):
-                for idx in range(self.dim):
-                    # Only works if dim == 6: (x, y, z, n_x, n_y, n_z)
-                    if self.dim == 6:
-                        self.data[y, x, idx] = struct.unpack("d", data.read(8))[0]
-        print()
+        data = inkid.util.get_raw_data_from_file_or_url(self._path)
+        data.seek(self._header_length)
+
+        # The body is row-major doubles in [y, x, idx] order, so it can be read
+        # straight into the array buffer rather than unpacked value by value
+        num_bytes = data.readinto(self.data)
+        if num_bytes != self.data.nbytes:
+            raise ValueError(
+                f"PPM {self._path} data is truncated: expected {self.data.nbytes} "
+                f"bytes but read {num_bytes}"
+            )
 
     def get_point_with_normal(self, ppm_x, ppm_y):
         self.ensure_loaded()
@@ -166,46 +210,33 @@ class PPM:
         self.width //= scale_factor
         self.height //= scale_factor
 
-        new_data = np.empty((self.height, self.width, self.dim))
-
         logging.info(
             "Downscaling PPM by factor of {} on all axes...".format(scale_factor)
         )
-        for y in tqdm(range(self.height)):
-            for x in range(self.width):
-                for idx in range(self.dim):
-                    new_data[y, x, idx] = self.data[
-                        y * scale_factor, x * scale_factor, idx
-                    ]
-
-        self.data = new_data
+        # Keep every scale_factor-th point on each axis, copied out of the strided view
+        self.data = np.ascontiguousarray(
+            self.data[
+                : self.height * scale_factor : scale_factor,
+                : self.width * scale_factor : scale_factor,
+            ]
+        )
 
     def translate(self, dx: int, dy: int, dz: int) -> None:
-        for ppm_y in tqdm(range(self.height)):
-            for ppm_x in range(self.width):
-                if np.any(self.data[ppm_y, ppm_x]):  # Leave empty pixels unchanged
-                    vol_x, vol_y, vol_z = self.data[ppm_y, ppm_x, 0:3]
-                    self.data[ppm_y, ppm_x, 0] = vol_x + dx
-                    self.data[ppm_y, ppm_x, 1] = vol_y + dy
-                    self.data[ppm_y, ppm_x, 2] = vol_z + dz
+        self.ensure_loaded()
+
+        # Leave empty pixels unchanged
+        non_empty = np.any(self.data, axis=2)
+        self.data[non_empty, 0:3] += (dx, dy, dz)
 
     def write(self, filename):
         self.ensure_loaded()
 
-        with open(filename, "wb") as f:
-            logging.info("Writing PPM to file {}...".format(filename))
-            f.write("width: {}\n".format(self.width).encode("utf-8"))
-            f.write("height: {}\n".format(self.height).encode("utf-8"))
-            f.write("dim: {}\n".format(self.dim).encode("utf-8"))
-            f.write(
-                "ordered: {}\n".format("true" if self.ordered else "false").encode(
-                    "utf-8"
-                )
-            )
-            f.write("type: double\n".encode("utf-8"))
-            f.write("version: {}\n".format(self.version).encode("utf-8"))
-            f.write("<>\n".encode("utf-8"))
-            for y in tqdm(range(self.height)):
-                for x in range(self.width):
-                    for idx in range(self.dim):
-                        f.write(struct.pack("d", self.data[y, x, idx]))
+        PPM.write_ppm_from_data(
+            filename,
+            self.data,
+            self.width,
+            self.height,
+            self.dim,
+            ordered=self.ordered,
+            version=self.version,
+        )
@@ -1,8 +1,25 @@
+import itertools
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
+import numpy as np
+
 import inkid
 
 
+def dummy_volume_path():
+    return os.path.join(
+        os.path.dirname(inkid.__file__),
+        "examples",
+        "DummyTest.volpkg",
+        "volumes",
+        "20200526145449",
+    )
+
+
 class VectorMathTestCase(unittest.TestCase):
     def test_get_component_vectors_from_normal_trivial(self):
         normal = {"x": 0, "y": 0, "z": 1}
@@ -41,5 +58,88 @@ class VectorMathTestCase(unittest.TestCase):
         )
 
 
+class InterpolationTestCase(unittest.TestCase):
+    def test_interpolated_subvolume_is_trilinear(self):
+        volume = inkid.data.Volume(dummy_volume_path())
+        # Fractional on every axis, exactly representable as float32
+        x, y, z = 450.25, 201.5, 120.75
+        x0, y0, z0 = 450, 201, 120
+        dx, dy, dz = x - x0, y - y0, z - z0
+        # Corners indexed [z, y, x] relative to (x0, y0, z0)
+        corners = np.stack([volume.z_slice(z0), volume.z_slice(z0 + 1)])[
+            :, y0 : y0 + 2, x0 : x0 + 2
+        ].astype(np.float64)
+        # The corners must vary along y at x0 + 1, or reading the wrong one
+        # would go unnoticed
+        self.assertNotEqual(corners[0, 0, 1], corners[0, 1, 1])
+
+        expected = 0.0
+        for k, j, i in itertools.product([0, 1], repeat=3):
+            weight = (
+                (dz if k else 1 - dz) * (dy if j else 1 - dy) * (dx if i else 1 - dx)
+            )
+            expected += weight * corners[k, j, i]
+
+        subvolume = volume.get_subvolume(
+            (x, y, z), (1, 1, 1), None, None, 0, 0, False, "interpolated"
+        )
+        # Leading axis is the channel
+        self.assertEqual(int(subvolume[0, 0, 0, 0]), int(expected))
+
+
+class VolumeCacheTestCase(unittest.TestCase):
+    def assertVolumesEqual(self, a, b):
+        self.assertEqual(a.shape(), b.shape())
+        for z in range(a.shape()[0]):
+            np.testing.assert_array_equal(a.z_slice(z), b.z_slice(z))
+
+    def test_cached_volume_matches_uncached(self):
+        for bounding_box in [None, (100, 50, 20, 400, 300, 150)]:
+            with self.subTest(bounding_box=bounding_box):
+                with tempfile.TemporaryDirectory() as cache_dir:
+                    uncached = inkid.data.Volume(dummy_volume_path(), bounding_box)
+                    built = inkid.data.Volume(
+                        dummy_volume_path(), bounding_box, cache_dir=cache_dir
+                    )
+                    cache_files = os.listdir(cache_dir)
+                    self.assertEqual(len(cache_files), 1)
+                    self.assertTrue(cache_files[0].endswith(".npy"))
+                    cache_mtime = os.path.getmtime(
+                        os.path.join(cache_dir, cache_files[0])
+                    )
+
+                    mapped = inkid.data.Volume(
+                        dummy_volume_path(), bounding_box, cache_dir=cache_dir
+                    )
+                    # Second load maps the existing cache rather than rebuilding it
+                    self.assertEqual(os.listdir(cache_dir), cache_files)
+                    self.assertEqual(
+                        os.path.getmtime(os.path.join(cache_dir, cache_files[0])),
+                        cache_mtime,
+                    )
+
+                    self.assertVolumesEqual(built, uncached)
+                    self.assertVolumesEqual(mapped, uncached)
+
+    def test_failed_load_removes_partial_cache(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            slices_dir = os.path.join(tmp_dir, "volume")
+            os.mkdir(slices_dir)
+            for filename in ["meta.json", "000.tif", "001.tif"]:
+                shutil.copy(os.path.join(dummy_volume_path(), filename), slices_dir)
+            with open(os.path.join(slices_dir, "meta.json")) as f:
+                metadata = json.load(f)
+            metadata["slices"] = 2
+            with open(os.path.join(slices_dir, "meta.json"), "w") as f:
+                json.dump(metadata, f)
+            with open(os.path.join(slices_dir, "001.tif"), "wb") as f:
+                f.write(b"not a tif")
+
+            cache_dir = os.path.join(tmp_dir, "cache")
+            with self.assertRaises(Exception):
+                inkid.data.Volume(slices_dir, cache_dir=cache_dir)
+            self.assertEqual(os.listdir(cache_dir), [])
+
+
 if __name__ == "__main__":
     unittest.main()
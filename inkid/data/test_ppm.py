@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import inkid
+
+
+def dummy_ppm_path():
+    return os.path.join(
+        os.path.dirname(inkid.__file__),
+        "examples",
+        "DummyTest.volpkg",
+        "paths",
+        "20200526152035",
+        "textSurface.ppm",
+    )
+
+
+class PPMTestCase(unittest.TestCase):
+    def test_translate_and_write_in_place(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "textSurface.ppm")
+            shutil.copy(dummy_ppm_path(), path)
+
+            original = np.array(inkid.data.PPM(path).data)
+            non_empty = np.any(original, axis=2)
+            expected = original.copy()
+            expected[non_empty, 0:3] += (1, 2, 3)
+
+            ppm = inkid.data.PPM(path)
+            ppm.translate(1, 2, 3)
+            ppm.write(path)
+
+            # The written object's data stays readable, and the file holds the
+            # translated points
+            np.testing.assert_array_equal(ppm.data, expected)
+            np.testing.assert_array_equal(inkid.data.PPM(path).data, expected)
+            self.assertEqual(os.listdir(tmp_dir), ["textSurface.ppm"])
+
+
+if __name__ == "__main__":
+    unittest.main()
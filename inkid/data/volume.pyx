@@ -3,6 +3,8 @@
 Define the Volume class to represent volumetric data.
 """
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import hashlib
 import json
 cimport libc.math as math
 import logging
@@ -81,6 +83,32 @@ cpdef BasisVectors get_component_vectors_from_normal(const Float3 n):
     return basis
 
 
+def volume_cache_path(slices_path, bounding_box, cache_dir):
+    """Return the path of the .npy file caching a volume (or a bounding box of it)."""
+    key = f'{os.path.abspath(slices_path)}:{bounding_box}'.encode('utf-8')
+    name = os.path.basename(os.path.normpath(slices_path))
+    return os.path.join(cache_dir, f'{name}_{hashlib.sha1(key).hexdigest()[:16]}.npy')
+
+
+def load_volume_cache(cache_path, shape, source_files):
+    """Memory-map a cached volume, or return None if it is missing or out of date."""
+    if not os.path.exists(cache_path):
+        return None
+    cache_mtime = os.path.getmtime(cache_path)
+    if any(os.path.getmtime(f) > cache_mtime for f in source_files):
+        return None
+    data = np.load(cache_path, mmap_mode='r')
+    if data.shape != shape or data.dtype != np.uint16:
+        return None
+    return data
+
+
+def read_slice_into(slice_file, crop, out):
+    # PIL releases the GIL while decoding, so slices can be read in threads
+    with Image.open(slice_file) as slice_img:
+        out[:, :] = np.asarray(slice_img, dtype=np.uint16)[crop]
+
+
 cdef class Volume:
     """Represent a volume and support accesses of the volume data.
 
@@ -109,13 +137,13 @@ cdef class Volume:
     initialized_volumes = dict()  # Dict[str, Volume]
 
     @classmethod
-    def from_path(cls, path: str, bounding_box: Optional[tuple] = None) -> Volume:
+    def from_path(cls, path: str, bounding_box: Optional[tuple] = None, cache_dir: Optional[str] = None) -> Volume:
         if path in cls.initialized_volumes:
             return cls.initialized_volumes[path]
-        cls.initialized_volumes[path] = Volume(path, bounding_box=bounding_box)
+        cls.initialized_volumes[path] = Volume(path, bounding_box=bounding_box, cache_dir=cache_dir)
         return cls.initialized_volumes[path]
     
-    def __init__(self, slices_path, bounding_box=None):
+    def __init__(self, slices_path, bounding_box=None, cache_dir=None):
         """Initialize a volume using a path to the slices directory.
 
         Get the absolute path and filename for each slice in the given
@@ -125,6 +153,13 @@ cdef class Volume:
         Ignores hidden files in that directory, but will get all other
         files, so it must be a directory with only image files.
 
+        If cache_dir is given, the loaded volume is also written there
+        as a .npy file. Later runs memory-map that file instead of
+        decoding the slices again, so only the parts of the volume
+        actually sampled are read from disk, and the page cache is
+        shared between processes (e.g. dataloader workers). The cache
+        is rebuilt if any slice or the metadata has changed since.
+
         """
 
         # Load metadata
@@ -165,17 +200,49 @@ cdef class Volume:
         slice_files = slice_files[self.offset_z:self.offset_z + self.shape_z]
         assert len(slice_files) == self.shape_z
 
-        # Load slice images into volume
-        logging.info('Loading volume slices from {}...'.format(slices_path))
-        data = np.empty((self.shape_z, self.shape_y, self.shape_x), dtype=np.uint16)
-        for slice_i, slice_file in tqdm(list(enumerate(slice_files))):
-            slice_img = Image.open(slice_file)
-            slice_np = np.array(slice_img, dtype=np.uint16)[
-                self.offset_y:self.offset_y + self.shape_y,
-                self.offset_x:self.offset_x + self.shape_x
-            ]
-            data[slice_i, :, :] = slice_np.copy()
-        print()
+        shape = (self.shape_z, self.shape_y, self.shape_x)
+        data = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            cache_path = volume_cache_path(slices_path, bounding_box, cache_dir)
+            data = load_volume_cache(cache_path, shape, slice_files + [metadata_filename])
+            if data is not None:
+                logging.info('Mapped cached volume {} from {}'.format(slices_path, cache_path))
+
+        if data is None:
+            # Load slice images into volume, streaming them straight into the
+            # cache file if there is one
+            logging.info('Loading volume slices from {}...'.format(slices_path))
+            if cache_dir is None:
+                data = np.empty(shape, dtype=np.uint16)
+            else:
+                # Write under a temporary name so concurrent jobs never map a partial cache
+                tmp_cache_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+                data = np.lib.format.open_memmap(tmp_cache_path, mode='w+', dtype=np.uint16, shape=shape)
+            crop = (
+                slice(self.offset_y, self.offset_y + self.shape_y),
+                slice(self.offset_x, self.offset_x + self.shape_x),
+            )
+            try:
+                # Decode slices in parallel, each straight into its place in the volume
+                with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+                    futures = [
+                        executor.submit(read_slice_into, slice_file, crop, data[slice_i])
+                        for slice_i, slice_file in enumerate(slice_files)
+                    ]
+                    for future in tqdm(as_completed(futures), total=len(futures)):
+                        future.result()
+            except BaseException:
+                # Don't leave a full-size partial cache file behind
+                if cache_dir is not None:
+                    os.remove(tmp_cache_path)
+                raise
+            print()
+            if cache_dir is not None:
+                data.flush()
+                del data
+                os.replace(tmp_cache_path, cache_path)
+                data = np.load(cache_path, mmap_mode='r')
         self._data_view = data
         logging.info('Loaded volume {} with shape (z, y, x) = {}'.format(
             slices_path,
@@ -222,26 +289,49 @@ cdef class Volume:
         https://stackoverflow.com/questions/6427276/3d-interpolation-of-numpy-arrays-without-scipy
 
         """
-        cdef double dx, dy, dz, x0d, y0d, z0d
+        cdef double dx, dy, dz
         cdef int x0, y0, z0, x1, y1, z1
+        cdef double c000, c100, c010, c110, c001, c101, c011, c111
         cdef double c00, c10, c01, c11, c0, c1
         cdef unsigned short c
-        dx = math.modf(x, &x0d)
-        dy = math.modf(y, &y0d)
-        dz = math.modf(z, &z0d)
 
-        x0 = <int> x0d
-        y0 = <int> y0d
-        z0 = <int> z0d
+        x0 = <int> math.floor(x)
+        y0 = <int> math.floor(y)
+        z0 = <int> math.floor(z)
+
+        dx = x - x0
+        dy = y - y0
+        dz = z - z0
 
         x1 = x0 + 1
         y1 = y0 + 1
         z1 = z0 + 1
 
-        c00 = self.intensity_at(x0, y0, z0) * (1 - dx) + self.intensity_at(x1, y0, z0) * dx
-        c10 = self.intensity_at(x0, y1, z0) * (1 - dx) + self.intensity_at(x1, y0, z0) * dx
-        c01 = self.intensity_at(x0, y0, z1) * (1 - dx) + self.intensity_at(x1, y0, z1) * dx
-        c11 = self.intensity_at(x0, y1, z1) * (1 - dx) + self.intensity_at(x1, y1, z1) * dx
+        if 0 <= x0 and x1 < self.shape_x and 0 <= y0 and y1 < self.shape_y and 0 <= z0 and z1 < self.shape_z:
+            # All eight neighbors are inside the volume (the usual case), so
+            # index the data directly rather than bounds checking each one
+            c000 = self._data_view[z0, y0, x0]
+            c100 = self._data_view[z0, y0, x1]
+            c010 = self._data_view[z0, y1, x0]
+            c110 = self._data_view[z0, y1, x1]
+            c001 = self._data_view[z1, y0, x0]
+            c101 = self._data_view[z1, y0, x1]
+            c011 = self._data_view[z1, y1, x0]
+            c111 = self._data_view[z1, y1, x1]
+        else:
+            c000 = self.intensity_at(x0, y0, z0)
+            c100 = self.intensity_at(x1, y0, z0)
+            c010 = self.intensity_at(x0, y1, z0)
+            c110 = self.intensity_at(x1, y1, z0)
+            c001 = self.intensity_at(x0, y0, z1)
+            c101 = self.intensity_at(x1, y0, z1)
+            c011 = self.intensity_at(x0, y1, z1)
+            c111 = self.intensity_at(x1, y1, z1)
+
+        c00 = c000 * (1 - dx) + c100 * dx
+        c10 = c010 * (1 - dx) + c110 * dx
+        c01 = c001 * (1 - dx) + c101 * dx
+        c11 = c011 * (1 - dx) + c111 * dx
 
         c0 = c00 * (1 - dy) + c10 * dy
         c1 = c01 * (1 - dy) + c11 * dy
@@ -274,19 +364,35 @@ cdef class Volume:
         y_r = shape[1] // 2
         x_r = shape[2] // 2
 
+        # Half extents of the window along volume (z, y, x)
         # z in subvolume space is along x in volume space
         if strongest_normal_axis == 0:
-            subvolume = np.asarray(self._data_view[z-y_r:z+y_r, y-x_r:y+x_r, x-z_r:x+z_r])
-            subvolume = np.rot90(subvolume, axes=(2, 0))
-
+            radii = (y_r, x_r, z_r)
         # z in subvolume space is along y in volume space
         elif strongest_normal_axis == 1:
-            subvolume = np.asarray(self._data_view[z-x_r:z+x_r, y-z_r:y+z_r, x-y_r:x+y_r])
-            subvolume = np.rot90(subvolume, axes=(1, 0))
-
+            radii = (x_r, z_r, y_r)
         # z in subvolume space is along z in volume space
-        elif strongest_normal_axis == 2:
-            subvolume = np.asarray(self._data_view[z-z_r:z+z_r, y-y_r:y+y_r, x-x_r:x+x_r])
+        else:
+            radii = (z_r, y_r, x_r)
+
+        # Copy the part of the window inside the volume into a zeroed
+        # buffer, so windows hanging off an edge are padded with zeros
+        # rather than discarded entirely
+        window = np.zeros([2 * r for r in radii], dtype=np.uint16)
+        volume_idx, window_idx = [], []
+        for c, r, limit in zip((z, y, x), radii, (self.shape_z, self.shape_y, self.shape_x)):
+            lo = max(c - r, 0)
+            hi = max(min(c + r, limit), lo)
+            volume_idx.append(slice(lo, hi))
+            window_idx.append(slice(lo - (c - r), hi - (c - r)))
+        window[tuple(window_idx)] = np.asarray(self._data_view)[tuple(volume_idx)]
+
+        if strongest_normal_axis == 0:
+            subvolume = np.rot90(window, axes=(2, 0))
+        elif strongest_normal_axis == 1:
+            subvolume = np.rot90(window, axes=(1, 0))
+        else:
+            subvolume = window
 
         # If the normal was pointed along a negative axis, flip the
         # subvolume over
@@ -301,8 +407,9 @@ cdef class Volume:
         return subvolume
 
     cdef void interpolated_with_basis_vectors(self, Float3 center, Int3 shape_voxels, Float3 shape_microns, BasisVectors basis, uint16[:,:,:] array) nogil:
-        cdef int x, y, z, x_offset, y_offset, z_offset
-        cdef Float3 volume_point, subvolume_voxel_size_microns, subvolume_voxel_size_volume_voxel_size_ratio
+        cdef int x, y, z
+        cdef Float3 volume_point, row_point, slice_point, subvolume_voxel_size_microns, subvolume_voxel_size_volume_voxel_size_ratio
+        cdef Float3 step_x, step_y, step_z
         cdef Int3 offset
 
         subvolume_voxel_size_microns.x = shape_microns.x / shape_voxels.x
@@ -312,37 +419,42 @@ cdef class Volume:
         subvolume_voxel_size_volume_voxel_size_ratio.x = subvolume_voxel_size_microns.x / self._voxelsize_um
         subvolume_voxel_size_volume_voxel_size_ratio.y = subvolume_voxel_size_microns.y / self._voxelsize_um
         subvolume_voxel_size_volume_voxel_size_ratio.z = subvolume_voxel_size_microns.z / self._voxelsize_um
-        
+
+        # Displacement in the volume for one subvolume voxel along each
+        # subvolume axis. These are constant over the whole subvolume.
+        step_x.x = basis.x.x * subvolume_voxel_size_volume_voxel_size_ratio.x
+        step_x.y = basis.x.y * subvolume_voxel_size_volume_voxel_size_ratio.x
+        step_x.z = basis.x.z * subvolume_voxel_size_volume_voxel_size_ratio.x
+
+        step_y.x = basis.y.x * subvolume_voxel_size_volume_voxel_size_ratio.y
+        step_y.y = basis.y.y * subvolume_voxel_size_volume_voxel_size_ratio.y
+        step_y.z = basis.y.z * subvolume_voxel_size_volume_voxel_size_ratio.y
+
+        step_z.x = basis.z.x * subvolume_voxel_size_volume_voxel_size_ratio.z
+        step_z.y = basis.z.y * subvolume_voxel_size_volume_voxel_size_ratio.z
+        step_z.z = basis.z.z * subvolume_voxel_size_volume_voxel_size_ratio.z
+
+        # Convert from an index relative to an origin in the corner to
+        # a position relative to the subvolume center (which may not
+        # correspond exactly to one of the subvolume voxel positions
+        # if any of the side lengths are even). Each loop level only
+        # adds its own axis to the point from the level above.
         for z in range(shape_voxels.z):
+            offset.z = <int>((-1 * (shape_voxels.z - 1) / 2.0 + z) + 0.5)
+            slice_point.x = center.x + offset.z * step_z.x
+            slice_point.y = center.y + offset.z * step_z.y
+            slice_point.z = center.z + offset.z * step_z.z
             for y in range(shape_voxels.y):
+                offset.y = <int>((-1 * (shape_voxels.y - 1) / 2.0 + y) + 0.5)
+                row_point.x = slice_point.x + offset.y * step_y.x
+                row_point.y = slice_point.y + offset.y * step_y.y
+                row_point.z = slice_point.z + offset.y * step_y.z
                 for x in range(shape_voxels.x):
-                    # Convert from an index relative to an origin in
-                    # the corner to a position relative to the
-                    # subvolume center (which may not correspond
-                    # exactly to one of the subvolume voxel positions
-                    # if any of the side lengths are even).
                     offset.x = <int>((-1 * (shape_voxels.x - 1) / 2.0 + x) + 0.5)
-                    offset.y = <int>((-1 * (shape_voxels.y - 1) / 2.0 + y) + 0.5)
-                    offset.z = <int>((-1 * (shape_voxels.z - 1) / 2.0 + z) + 0.5)
-
-                    # Calculate the corresponding position in the
-                    # volume.
-                    volume_point.x = center.x
-                    volume_point.y = center.y
-                    volume_point.z = center.z
-                    
-                    volume_point.x += offset.x * basis.x.x * subvolume_voxel_size_volume_voxel_size_ratio.x
-                    volume_point.y += offset.x * basis.x.y * subvolume_voxel_size_volume_voxel_size_ratio.x
-                    volume_point.z += offset.x * basis.x.z * subvolume_voxel_size_volume_voxel_size_ratio.x
-
-                    volume_point.x += offset.y * basis.y.x * subvolume_voxel_size_volume_voxel_size_ratio.y
-                    volume_point.y += offset.y * basis.y.y * subvolume_voxel_size_volume_voxel_size_ratio.y
-                    volume_point.z += offset.y * basis.y.z * subvolume_voxel_size_volume_voxel_size_ratio.y
-
-                    volume_point.x += offset.z * basis.z.x * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    volume_point.y += offset.z * basis.z.y * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    volume_point.z += offset.z * basis.z.z * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    
+                    volume_point.x = row_point.x + offset.x * step_x.x
+                    volume_point.y = row_point.y + offset.x * step_x.y
+                    volume_point.z = row_point.z + offset.x * step_x.z
+
                     array[z, y, x] = self.interpolate_at(
                         volume_point.x,
                         volume_point.y,
@@ -350,8 +462,9 @@ cdef class Volume:
                     )
 
     cdef void nearest_neighbor_with_basis_vectors(self, Float3 center, Int3 shape_voxels, Float3 shape_microns, BasisVectors basis, uint16[:,:,:] array) nogil:
-        cdef int x, y, z, x_offset, y_offset, z_offset
-        cdef Float3 volume_point, subvolume_voxel_size_microns, subvolume_voxel_size_volume_voxel_size_ratio
+        cdef int x, y, z
+        cdef Float3 volume_point, row_point, slice_point, subvolume_voxel_size_microns, subvolume_voxel_size_volume_voxel_size_ratio
+        cdef Float3 step_x, step_y, step_z
         cdef Int3 offset
 
         subvolume_voxel_size_microns.x = shape_microns.x / shape_voxels.x
@@ -361,37 +474,42 @@ cdef class Volume:
         subvolume_voxel_size_volume_voxel_size_ratio.x = subvolume_voxel_size_microns.x / self._voxelsize_um
         subvolume_voxel_size_volume_voxel_size_ratio.y = subvolume_voxel_size_microns.y / self._voxelsize_um
         subvolume_voxel_size_volume_voxel_size_ratio.z = subvolume_voxel_size_microns.z / self._voxelsize_um
-        
+
+        # Displacement in the volume for one subvolume voxel along each
+        # subvolume axis. These are constant over the whole subvolume.
+        step_x.x = basis.x.x * subvolume_voxel_size_volume_voxel_size_ratio.x
+        step_x.y = basis.x.y * subvolume_voxel_size_volume_voxel_size_ratio.x
+        step_x.z = basis.x.z * subvolume_voxel_size_volume_voxel_size_ratio.x
+
+        step_y.x = basis.y.x * subvolume_voxel_size_volume_voxel_size_ratio.y
+        step_y.y = basis.y.y * subvolume_voxel_size_volume_voxel_size_ratio.y
+        step_y.z = basis.y.z * subvolume_voxel_size_volume_voxel_size_ratio.y
+
+        step_z.x = basis.z.x * subvolume_voxel_size_volume_voxel_size_ratio.z
+        step_z.y = basis.z.y * subvolume_voxel_size_volume_voxel_size_ratio.z
+        step_z.z = basis.z.z * subvolume_voxel_size_volume_voxel_size_ratio.z
+
+        # Convert from an index relative to an origin in the corner to
+        # a position relative to the subvolume center (which may not
+        # correspond exactly to one of the subvolume voxel positions
+        # if any of the side lengths are even). Each loop level only
+        # adds its own axis to the point from the level above.
         for z in range(shape_voxels.z):
+            offset.z = <int>((-1 * (shape_voxels.z - 1) / 2.0 + z) + 0.5)
+            slice_point.x = center.x + offset.z * step_z.x
+            slice_point.y = center.y + offset.z * step_z.y
+            slice_point.z = center.z + offset.z * step_z.z
             for y in range(shape_voxels.y):
+                offset.y = <int>((-1 * (shape_voxels.y - 1) / 2.0 + y) + 0.5)
+                row_point.x = slice_point.x + offset.y * step_y.x
+                row_point.y = slice_point.y + offset.y * step_y.y
+                row_point.z = slice_point.z + offset.y * step_y.z
                 for x in range(shape_voxels.x):
-                    # Convert from an index relative to an origin in
-                    # the corner to a position relative to the
-                    # subvolume center (which may not correspond
-                    # exactly to one of the subvolume voxel positions
-                    # if any of the side lengths are even).
                     offset.x = <int>((-1 * (shape_voxels.x - 1) / 2.0 + x) + 0.5)
-                    offset.y = <int>((-1 * (shape_voxels.y - 1) / 2.0 + y) + 0.5)
-                    offset.z = <int>((-1 * (shape_voxels.z - 1) / 2.0 + z) + 0.5)
-
-                    # Calculate the corresponding position in the
-                    # volume.
-                    volume_point.x = center.x
-                    volume_point.y = center.y
-                    volume_point.z = center.z
-
-                    volume_point.x += offset.x * basis.x.x * subvolume_voxel_size_volume_voxel_size_ratio.x
-                    volume_point.y += offset.x * basis.x.y * subvolume_voxel_size_volume_voxel_size_ratio.x
-                    volume_point.z += offset.x * basis.x.z * subvolume_voxel_size_volume_voxel_size_ratio.x
-
-                    volume_point.x += offset.y * basis.y.x * subvolume_voxel_size_volume_voxel_size_ratio.y
-                    volume_point.y += offset.y * basis.y.y * subvolume_voxel_size_volume_voxel_size_ratio.y
-                    volume_point.z += offset.y * basis.y.z * subvolume_voxel_size_volume_voxel_size_ratio.y
-
-                    volume_point.x += offset.z * basis.z.x * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    volume_point.y += offset.z * basis.z.y * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    volume_point.z += offset.z * basis.z.z * subvolume_voxel_size_volume_voxel_size_ratio.z
-                    
+                    volume_point.x = row_point.x + offset.x * step_x.x
+                    volume_point.y = row_point.y + offset.x * step_x.y
+                    volume_point.z = row_point.z + offset.x * step_x.z
+
                     array[z, y, x] = self.intensity_at(
                         <int>(volume_point.x + 0.5),
                         <int>(volume_point.y + 0.5),
@@ -473,7 +591,8 @@ cdef class Volume:
         s_m.y = shape_microns[1]
         s_m.x = shape_microns[2]
 
-        subvolume = np.zeros(shape_voxels, dtype=np.uint16)
+        # Every voxel is written by the sampling loops below
+        subvolume = np.empty(shape_voxels, dtype=np.uint16)
 
         basis = get_component_vectors_from_normal(n)
         if method is None:
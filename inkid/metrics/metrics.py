@@ -9,18 +9,15 @@ import torch
 def confusion(prediction, truth):
     prediction = torch.argmax(prediction, 1)
 
-    # Element-wise division of the 2 tensors returns a new tensor which holds a
-    # unique value for each case:
-    #   1     where prediction and truth are 1 (True Positive)
-    #   inf   where prediction is 1 and truth is 0 (False Positive)
-    #   nan   where prediction and truth are 0 (True Negative)
-    #   0     where prediction is 0 and truth is 1 (False Negative)
-    confusion_vector = prediction.float() / truth.float()
-
-    true_positives = torch.sum(confusion_vector == 1).item()
-    false_positives = torch.sum(confusion_vector == float("inf")).item()
-    true_negatives = torch.sum(torch.isnan(confusion_vector)).item()
-    false_negatives = torch.sum(confusion_vector == 0).item()
+    # Encode each (truth, prediction) pair as 2 * truth + prediction so all
+    # four cases can be counted in a single pass:
+    #   0   where prediction and truth are 0 (True Negative)
+    #   1   where prediction is 1 and truth is 0 (False Positive)
+    #   2   where prediction is 0 and truth is 1 (False Negative)
+    #   3   where prediction and truth are 1 (True Positive)
+    cases = 2 * truth.long() + prediction.long()
+    counts = torch.bincount(cases.reshape(-1), minlength=4).tolist()
+    true_negatives, false_positives, false_negatives, true_positives = counts
 
     return true_positives, false_positives, true_negatives, false_negatives
 
@@ -91,7 +88,8 @@ def negative_preds(pred, yb):
 
 
 def positive_labels(_, yb):
-    return int(sum(yb))
+    # Builtin sum() would iterate the tensor one 0-d element at a time
+    return int(torch.count_nonzero(yb))
 
 
 def negative_labels(_, yb):
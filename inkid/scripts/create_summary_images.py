@@ -76,7 +76,7 @@ def get_preds_and_labels(pred_img, label_img, mask_img=None, bounding_box=None):
     preds = np.vstack((1 - preds, preds)).transpose()
 
     # Convert label image pixel values to class indices (0: not ink, 1: ink)
-    labels = np.where(labels > 0, 1, 0)
+    labels = (labels > 0).astype(np.int64)
 
     return preds, labels
 
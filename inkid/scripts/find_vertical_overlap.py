@@ -31,7 +31,7 @@ def mutual_information(im_1, im_2, num_bins=20):
 def pearson_correlation(x, y, filter_sigma=3):
     x_filtered = median_filter(x, filter_sigma)
     y_filtered = median_filter(y, filter_sigma)
-    z = pearsonr(x_filtered.flatten(), y_filtered.flatten())
+    z = pearsonr(x_filtered.ravel(), y_filtered.ravel())
 
     return z
 
@@ -81,10 +81,10 @@ def render_3d_volume_plotly(subvol, direction, color="jet"):
     x, y, z = np.mgrid[0:size_x, 0:size_y, 0:size_z]
 
     vol = go.Volume(
-        x=x.flatten(),
-        y=y.flatten(),
-        z=z.flatten(),
-        value=subvol.flatten(),
+        x=x.ravel(),
+        y=y.ravel(),
+        z=z.ravel(),
+        value=subvol.ravel(),
         opacity=0.3,
         opacityscale=0.3,
         surface_count=10,
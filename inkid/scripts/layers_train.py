@@ -1,6 +1,5 @@
 import argparse
 import datetime
-import itertools
 import logging
 import multiprocessing
 from pathlib import Path
@@ -181,30 +180,31 @@ class StackDataset(Dataset):
         self.patch_size: int = patch_size
         self.stride: int = stride
 
-        # Generate possible points
-        self.points_lists = []
+        # Possible points form a stride grid over each image. Rather than list
+        # every point, keep each grid's width and the index it starts at so a
+        # point can be found with a search and a divmod
+        self.grid_widths = []
+        grid_sizes = []
         for feature_img in self.feature_imgs:
             ys = range(0, feature_img.shape[1], stride)
             xs = range(0, feature_img.shape[2], stride)
-            self.points_lists.append(list(itertools.product(ys, xs)))
+            self.grid_widths.append(len(xs))
+            grid_sizes.append(len(ys) * len(xs))
+        self.grid_starts = np.cumsum([0] + grid_sizes)
 
         # TODO mask these
 
     def __len__(self) -> int:
-        return sum([len(points_list) for points_list in self.points_lists])
+        return int(self.grid_starts[-1])
 
     def __getitem__(self, idx):
-        i = x = y = None
-        for i, points_list in enumerate(self.points_lists):
-            points_list_len = len(points_list)
-            if idx < points_list_len:
-                y, x = points_list[idx]
-                break
-            idx -= points_list_len
-
-        if y is None:
+        if not 0 <= idx < len(self):
             raise IndexError
 
+        i = int(np.searchsorted(self.grid_starts, idx, side="right")) - 1
+        row, col = divmod(idx - int(self.grid_starts[i]), self.grid_widths[i])
+        y, x = row * self.stride, col * self.stride
+
         feature = np.zeros(
             (self.feature_imgs[0].shape[0], self.patch_size, self.patch_size),
             dtype=self.feature_imgs[0].dtype,
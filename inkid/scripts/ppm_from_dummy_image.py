@@ -1,10 +1,8 @@
 import argparse
 from pathlib import Path
-import struct
 
 import numpy as np
 from PIL import Image
-from tqdm import tqdm
 
 
 def main():
@@ -57,10 +55,7 @@ def main():
         f.write("type: double\n".encode("utf-8"))
         f.write("version: {}\n".format(version).encode("utf-8"))
         f.write("<>\n".encode("utf-8"))
-        for y in tqdm(range(h)):
-            for x in range(w):
-                for idx in range(dim):
-                    f.write(struct.pack("d", ppm_data[y, x, idx]))
+        f.write(ppm_data.tobytes())
 
 
 if __name__ == "__main__":
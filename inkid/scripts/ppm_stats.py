@@ -16,12 +16,13 @@ def main():
     root = os.path.splitext(args.ppm)[0]
     mask_file = root + "_mask.png"
     mask = Image.open(mask_file).convert("1")
-    mask_arr = np.array(mask).flatten()
+    mask_arr = np.array(mask)
     ppm = inkid.data.PPM(args.ppm)
 
-    vol_xs = ppm.data[:, :, 0].flatten()[mask_arr]
-    vol_ys = ppm.data[:, :, 1].flatten()[mask_arr]
-    vol_zs = ppm.data[:, :, 2].flatten()[mask_arr]
+    # Index with the 2D mask directly rather than flattening copies of each channel
+    vol_xs = ppm.data[mask_arr, 0]
+    vol_ys = ppm.data[mask_arr, 1]
+    vol_zs = ppm.data[mask_arr, 2]
 
     b = args.buffer
     xmin, xmax = int(np.amin(vol_xs)) - b, int(np.amax(vol_xs)) + b
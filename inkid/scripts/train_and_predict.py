@@ -222,6 +222,12 @@ def main(argv=None):
         "--wandb-entity", metavar="entity", default="educelab", help="WandB entity name"
     )
     parser.add_argument("--dataloaders-num-workers", metavar="n", type=int, default=0)
+    parser.add_argument(
+        "--volume-cache-dir",
+        metavar="path",
+        default=None,
+        help="directory in which to cache loaded volumes so later jobs can memory-map them",
+    )
     parser.add_argument("--random-seed", type=int, default=42)
 
     args = parser.parse_args(argv)
@@ -477,15 +483,29 @@ def main(argv=None):
         args.validation_set.append(nth_source)
         args.prediction_set.append(nth_source)
 
-    train_ds = inkid.data.Dataset(args.training_set)
-    val_ds = inkid.data.Dataset(args.validation_set)
-    pred_ds = inkid.data.Dataset(args.prediction_set)
+    train_ds = inkid.data.Dataset(
+        args.training_set, volume_cache_dir=args.volume_cache_dir
+    )
+    val_ds = inkid.data.Dataset(
+        args.validation_set, volume_cache_dir=args.volume_cache_dir
+    )
+    pred_ds = inkid.data.Dataset(
+        args.prediction_set, volume_cache_dir=args.volume_cache_dir
+    )
 
     # Perform cross validation after flattening the sources into their expanded lists
     if args.cross_validate_on is not None and not args.cross_validate_at_top_level:
         nth_region_path = train_ds.pop_nth_region(args.cross_validate_on).path
-        val_ds.sources.append(inkid.data.DataSource.from_path(nth_region_path))
-        pred_ds.sources.append(inkid.data.DataSource.from_path(nth_region_path))
+        val_ds.sources.append(
+            inkid.data.DataSource.from_path(
+                nth_region_path, volume_cache_dir=args.volume_cache_dir
+            )
+        )
+        pred_ds.sources.append(
+            inkid.data.DataSource.from_path(
+                nth_region_path, volume_cache_dir=args.volume_cache_dir
+            )
+        )
 
     for region in train_ds.regions():
         region.sampler = copy.deepcopy(train_sampler)
@@ -548,7 +568,24 @@ def main(argv=None):
         val_sampler = None
         shuffle_val_dl = True
 
+    # Specify the compute device for PyTorch purposes
+    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    logging.info(f"PyTorch device: {device}")
+    if device.type == "cuda":
+        logging.info(f"    {torch.cuda.get_device_name(0)}")
+        logging.info(
+            f"    Memory Allocated: {round(torch.cuda.memory_allocated(0) / 1024 ** 3, 1)} GB"
+        )
+        logging.info(
+            f"    Memory Cached:    {round(torch.cuda.memory_reserved(0) / 1024 ** 3, 1)} GB"
+        )
+
     # Define the dataloaders which implement batching, shuffling, etc.
+    # Pinned host memory lets batches be copied to the GPU asynchronously.
+    # Validation and prediction are run many times during training, so keep
+    # their workers alive between passes instead of respawning them each time.
+    pin_memory = device.type == "cuda"
+    persistent_workers = args.dataloaders_num_workers > 0
     logging.info("Creating dataloaders...")
     train_dl, val_dl, pred_dl = None, None, None
     if len(train_ds) > 0:
@@ -558,6 +595,7 @@ def main(argv=None):
             shuffle=shuffle_train_dl,
             num_workers=args.dataloaders_num_workers,
             sampler=train_sampler,
+            pin_memory=pin_memory,
         )
     if len(val_ds) > 0:
         val_dl = DataLoader(
@@ -566,6 +604,8 @@ def main(argv=None):
             shuffle=shuffle_val_dl,
             num_workers=args.dataloaders_num_workers,
             sampler=val_sampler,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
         )
     if len(pred_ds) > 0:
         pred_dl = DataLoader(
@@ -573,21 +613,11 @@ def main(argv=None):
             batch_size=args.batch_size * 2,
             shuffle=True,  # Not really necessary for actual prediction but helps sample visualization
             num_workers=args.dataloaders_num_workers,
+            pin_memory=pin_memory,
+            persistent_workers=persistent_workers,
         )
     logging.info("done")
 
-    # Specify the compute device for PyTorch purposes
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
-    logging.info(f"PyTorch device: {device}")
-    if device.type == "cuda":
-        logging.info(f"    {torch.cuda.get_device_name(0)}")
-        logging.info(
-            f"    Memory Allocated: {round(torch.cuda.memory_allocated(0) / 1024 ** 3, 1)} GB"
-        )
-        logging.info(
-            f"    Memory Cached:    {round(torch.cuda.memory_reserved(0) / 1024 ** 3, 1)} GB"
-        )
-
     # Load pretrained weights if specified, and freeze them
     if args.load_weights_from is not None:
         logging.info("Loading pretrained weights...")
@@ -717,7 +747,7 @@ def main(argv=None):
             total_batches = len(train_dl)
             for batch_num, batch in enumerate(train_dl):
                 xb = batch["feature"]
-                xb = xb.to(device)
+                xb = xb.to(device, non_blocking=True)
                 if args.training_domain_transfer_weights is not None:
                     xb = torch.squeeze(xb, 1)
                     xb = training_domain_transfer_model(xb)
@@ -728,7 +758,7 @@ def main(argv=None):
                     yb = (
                         xb.clone()
                         if label_type == "autoencoded"
-                        else batch[label_type].to(device)
+                        else batch[label_type].to(device, non_blocking=True)
                     )
                     pred = preds[label_type]
                     for metric, fn in metrics[label_type].items():
@@ -862,7 +892,9 @@ def main(argv=None):
             all_sources = list(
                 set(args.training_set + args.validation_set + args.prediction_set)
             )
-            final_pred_ds = inkid.data.Dataset(all_sources)
+            final_pred_ds = inkid.data.Dataset(
+                all_sources, volume_cache_dir=args.volume_cache_dir
+            )
             for region in final_pred_ds.regions():
                 region.sampler = copy.deepcopy(pred_sampler)
                 region.feature_args = pred_feature_args
@@ -872,6 +904,7 @@ def main(argv=None):
                     batch_size=args.batch_size * 2,
                     shuffle=False,
                     num_workers=args.dataloaders_num_workers,
+                    pin_memory=pin_memory,
                 )
                 inkid.util.generate_prediction_images(
                     final_pred_dl,
@@ -1,4 +1,5 @@
 import argparse
+from multiprocessing import Pool
 from pathlib import Path
 
 import imageio.v3 as iio
@@ -8,6 +9,19 @@ from scipy.ndimage import gaussian_filter
 from tqdm import tqdm
 
 
+def slice_stats(slice_path):
+    img = iio.imread(slice_path)
+    filtered_img = gaussian_filter(img, 3)
+    return (
+        np.amin(img),
+        np.amax(img),
+        np.mean(img),
+        np.amin(filtered_img),
+        np.amax(filtered_img),
+        np.mean(filtered_img),
+    )
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -25,26 +39,17 @@ def main():
     slice_paths = sorted(input_slices_dir.glob("*.tif"))
     slice_paths = slice_paths[:: args.slice_skip]
 
-    slice_indices = []
-    mins = []
-    maxs = []
-    means = []
-    blurred_mins = []
-    blurred_maxs = []
-    blurred_means = []
-
-    for slice_path in tqdm(slice_paths):
-        slice_indices.append(int(slice_path.stem))
-
-        img = iio.imread(slice_path)
-        mins.append(np.amin(img))
-        maxs.append(np.amax(img))
-        means.append(np.mean(img))
+    slice_indices = [int(slice_path.stem) for slice_path in slice_paths]
 
-        filtered_img = gaussian_filter(img, 3)
-        blurred_mins.append(np.amin(filtered_img))
-        blurred_maxs.append(np.amax(filtered_img))
-        blurred_means.append(np.mean(filtered_img))
+    # Slices are independent, so read and filter them across all cores
+    with Pool() as worker_pool:
+        stats = list(
+            tqdm(
+                worker_pool.imap(slice_stats, slice_paths),
+                total=len(slice_paths),
+            )
+        )
+    mins, maxs, means, blurred_mins, blurred_maxs, blurred_means = zip(*stats)
 
     print(f"Global raw min: {np.amin(mins)}")
     print(f"Global raw max: {np.amax(maxs)}")
@@ -47,7 +47,7 @@ def perform_validation(model, dataloader, metrics, device, domain_transfer_model
             for label_type in metrics
         }
         for batch in tqdm(dataloader):
-            xb = batch["feature"].to(device)
+            xb = batch["feature"].to(device, non_blocking=True)
             if domain_transfer_model is not None:
                 xb = torch.squeeze(xb, 1)
                 xb = domain_transfer_model(xb)
@@ -58,7 +58,7 @@ def perform_validation(model, dataloader, metrics, device, domain_transfer_model
                 yb = (
                     xb.clone()
                     if label_type == "autoencoded"
-                    else batch[label_type].to(device)
+                    else batch[label_type].to(device, non_blocking=True)
                 )
                 pred = preds[label_type]
                 for metric, fn in metrics[label_type].items():
@@ -95,11 +95,6 @@ def generate_prediction_images(
                 "rgb_values",
                 "volcart_texture",
             }.intersection(getattr(model, "module", model).labels):
-                output_size = {
-                    "volcart_texture": 1,
-                    "ink_classes": 2,
-                    "rgb_values": 3,
-                }[label_type]
                 # Smooth predictions via augmentation. Augment each subvolume 8-fold via rotations and flips
                 if prediction_averaging:
                     rotations = range(4)
@@ -107,8 +102,9 @@ def generate_prediction_images(
                 else:
                     rotations = [0]
                     flips = [False]
-                batch_preds = None
-                for rotation, flip in itertools.product(rotations, flips):
+                augmentations = list(itertools.product(rotations, flips))
+                batch_preds_sum = None
+                for rotation, flip in augmentations:
                     # Example batch_features.shape = [64, 1, 48, 48, 48] (BxCxDxHxW)
                     # Augment via rotation and flip
                     aug_pxb = batch_features.rot90(rotation, [3, 4])
@@ -131,22 +127,14 @@ def generate_prediction_images(
                     if flip:
                         pred = pred.flip(3)
                     pred = pred.rot90(-rotation, [2, 3])
-                    pred = np.expand_dims(pred.numpy(), axis=0)
-                    # Example pred.shape = [1, 64, 2, 48, 48] (BxCxHxW)
-                    # Save this augmentation to the batch totals
-                    if batch_preds is None:
-                        batch_preds = np.zeros(
-                            (
-                                0,
-                                batch_features.shape[0],
-                                output_size,
-                                pred.shape[3],
-                                pred.shape[4],
-                            )
-                        )
-                    batch_preds = np.append(batch_preds, pred, axis=0)
+                    pred = pred.numpy()
+                    # Add this augmentation to the batch totals in place rather
+                    # than appending it to a growing stack of predictions
+                    if batch_preds_sum is None:
+                        batch_preds_sum = np.zeros(pred.shape)
+                    batch_preds_sum += pred
                 # Average over batch of predictions after augmentation
-                batch_pred = batch_preds.mean(0)
+                batch_pred = batch_preds_sum / len(augmentations)
                 # Separate these three lists
                 source_paths, xs, ys, _, _, _, _, _, _ = batch_metadata
                 for prediction, source_path, x, y in zip(